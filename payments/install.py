@@ -41,6 +41,7 @@ def create_custom_fields():
                 "label": "Stripe Invoice ID",
                 "fieldtype": "Data",
                 "read_only": 1,
+                "search_index": 1,
                 "insert_after": "stripe_invoice_url"
             },
             {
@@ -0,0 +1,6 @@
+from payments.install import create_custom_fields
+
+
+def execute():
+    """Re-sync custom fields so Payment Request.stripe_invoice_id gets its search index."""
+    create_custom_fields()
@@ -18,6 +18,12 @@ class StripeSettings(Document):
         if self.api_key:
             self.test_mode = self.api_key.startswith("sk_test_")
 
+    def on_update(self):
+        """Invalidate the cached settings so the new keys take effect."""
+        from payments.utils import clear_stripe_settings_cache
+
+        clear_stripe_settings_cache()
+
     def validate_transaction_currency(self, currency):
         """Validate transaction currency."""
         pass  # Stripe supports most currencies, so we allow all
@@ -30,9 +36,11 @@ class StripeSettings(Document):
         
     @staticmethod
     def get_stripe_settings():
-        """Get Stripe Settings singleton."""
-        settings = frappe.get_single("Stripe Settings")
-        if not settings.api_key:
+        """Get Stripe Settings singleton, throwing if the API key is not configured."""
+        from payments.utils import get_stripe_settings
+
+        settings = get_stripe_settings()
+        if not settings:
             frappe.throw("Stripe API Key not configured. Please configure in Stripe Settings.")
         return settings
     
@@ -40,6 +48,8 @@ class StripeSettings(Document):
     def get_stripe_client():
         """Get initialized Stripe client."""
         import stripe
-        settings = StripeSettings.get_stripe_settings()
-        stripe.api_key = settings.get_password("api_key")
+        from payments.utils import get_stripe_api_key
+
+        StripeSettings.get_stripe_settings()
+        stripe.api_key = get_stripe_api_key()
         return stripe
@@ -2,20 +2,58 @@
 # For license information, please see license.txt
 
 import frappe
+import stripe
 from frappe import _
-from frappe.utils import now_datetime, get_datetime, time_diff_in_seconds
-import json
+from frappe.utils import get_datetime
+from functools import partial
+from redis.exceptions import LockError
+import hashlib
+import time
 
 
 # Rate limiting: Minimum seconds between invoice creation attempts
 RATE_LIMIT_SECONDS = 5
 
+# Seconds a worker serves Stripe Settings from memory before re-reading the DB
+SETTINGS_CACHE_TTL = 60
+
+# Country values (lowercased) treated as US — cards and Stripe invoicing are US-only
+US_COUNTRY_NAMES = frozenset({"us", "united states", "united states of america", "usa"})
+
+# Stripe payment_method_types for US invoices
+ACH_ONLY_METHODS = ('us_bank_account',)  # ACH Direct Debit
+ACH_CARD_METHODS = ('us_bank_account', 'card')
+
+# Process-local Stripe Settings cache, keyed by site
+_settings_cache = {}
+
+# Process-local record of rate-limited keys, keyed by (site, name) -> monotonic expiry
+_rate_limit_local = {}
+RATE_LIMIT_LOCAL_MAXSIZE = 10000
+
+# Seconds an email -> Stripe Customer ID lookup is cached in Redis (shared by web and job workers)
+STRIPE_CUSTOMER_CACHE_TTL = 3600
+
+# Request timeout (seconds) of stripe-python's default HTTP client
+STRIPE_HTTP_TIMEOUT = 80
+
+# Per-email lock around Stripe customer lookup + create: held across two Stripe
+# calls, so it must outlive both; waiters give up after STRIPE_CUSTOMER_LOCK_WAIT
+STRIPE_CUSTOMER_LOCK_TIMEOUT = 2 * STRIPE_HTTP_TIMEOUT + 10
+STRIPE_CUSTOMER_LOCK_WAIT = 30
+
+# Reference document fields that may hold a due date, in priority order
+DUE_DATE_FIELDS = ('due_date', 'payment_due_date', 'bill_date')
+
 
 def create_stripe_invoice(doc, method=None):
     """
-    Create a Stripe Invoice for a Payment Request.
+    Queue creation of a Stripe Invoice for a Payment Request.
     Triggered by on_submit hook on Payment Request.
 
+    The Stripe API calls run in a background job once the submit has been
+    committed, so the user's request doesn't wait on Stripe round-trips.
+
     Args:
         doc: Payment Request document
         method: Hook method name (unused)
@@ -25,44 +63,94 @@ def create_stripe_invoice(doc, method=None):
     if not settings or not settings.enable_automatic_checkout:
         return
 
-    # Rate limit check
-    if is_rate_limited(doc.name):
-        frappe.log_error(
-            f"Rate limited: Skipping invoice creation for {doc.name}",
-            "Stripe Integration"
-        )
-        return
-
     # Check if this is an amended document with stale Stripe data
     if doc.amended_from and doc.stripe_invoice_id:
-        # Clear stale Stripe fields from the amended document
-        doc.stripe_invoice_id = None
-        doc.stripe_invoice_url = None
-        doc.stripe_payment_status = None
-        doc.stripe_payment_intent_id = None
-        frappe.log_error(
-            f"Cleared stale Stripe data from amended document {doc.name} (amended from {doc.amended_from})",
-            "Stripe Integration"
+        # Clear stale Stripe fields from the amended document (persisted, the job reloads it)
+        doc.db_set({
+            'stripe_invoice_id': None,
+            'stripe_invoice_url': None,
+            'stripe_payment_status': None,
+            'stripe_payment_intent_id': None
+        }, update_modified=False)
+        frappe.logger("stripe_integration").info(
+            f"Cleared stale Stripe data from amended document {doc.name} (amended from {doc.amended_from})"
         )
 
     # Check if invoice already exists (for non-amended documents)
     if doc.stripe_invoice_id:
-        frappe.log_error(
-            f"Invoice already exists for {doc.name}: {doc.stripe_invoice_id}",
-            "Stripe Integration"
-        )
+        frappe.logger("stripe_integration").info(f"Invoice already exists for {doc.name}: {doc.stripe_invoice_id}")
         return
-    
+
+    # Fail the submit now rather than in the background job
+    validate_payment_request_for_stripe(doc)
+
+    # International customers are decided here, where the user still sees the alert
+    customer = get_erpnext_customer(doc)
+    customer_country = get_customer_country(customer) if customer else "US"
+    if not is_us_country(customer_country):
+        skip_international_customer(doc)
+        return
+
+    # Rate limit check - claimed only once the submit is otherwise good to go, and
+    # given back if the transaction rolls back so a corrected resubmit isn't skipped
+    if is_rate_limited(doc.name):
+        frappe.logger("stripe_integration").info(f"Rate limited: Skipping invoice creation for {doc.name}")
+        return
+    frappe.db.after_rollback.add(partial(release_rate_limit, doc.name))
+
+    frappe.enqueue(
+        "payments.utils.create_stripe_invoice_job",
+        queue="short",
+        payment_request_name=doc.name,
+        customer_country=customer_country,
+        enqueue_after_commit=True
+    )
+
+    frappe.msgprint(
+        _("Creating Stripe Invoice in the background. The payment link will appear on this form shortly."),
+        alert=True,
+        indicator='blue'
+    )
+
+
+def create_stripe_invoice_job(payment_request_name, customer_country=None):
+    """
+    Background job: create the Stripe Invoice for a submitted Payment Request.
+    Enqueued by create_stripe_invoice.
+
+    Args:
+        payment_request_name: Name of Payment Request
+        customer_country: Country already resolved by the submit hook
+    """
+    doc = frappe.get_doc("Payment Request", payment_request_name)
+
+    # Skip if cancelled, or an invoice was already created (e.g. regenerated) since enqueue
+    if doc.docstatus != 1 or doc.stripe_invoice_id:
+        return
+
     try:
-        _create_stripe_invoice_internal(doc)
+        _create_stripe_invoice_internal(doc, customer_country=customer_country)
     except Exception as e:
         frappe.log_error(
             f"Error creating Stripe invoice for {doc.name}: {str(e)}",
             "Stripe Integration Error"
         )
+        notify_job_user(
+            _("Stripe Invoice could not be created for {0}: {1}").format(doc.name, str(e)),
+            title=_("Stripe Integration Error")
+        )
         raise
 
 
+def validate_payment_request_for_stripe(doc):
+    """Ensure a Payment Request has what a Stripe Invoice needs (amount and email)."""
+    if not doc.grand_total or doc.grand_total <= 0:
+        frappe.throw(_("Payment Request must have a valid amount"))
+
+    if not doc.email_to:
+        frappe.throw(_("Payment Request must have a customer email"))
+
+
 def handle_payment_request_update(doc, method=None):
     """
     Handle updates to Payment Request.
@@ -81,40 +169,32 @@ def handle_payment_request_update(doc, method=None):
     old_doc = doc.get_doc_before_save()
     if old_doc and old_doc.allow_card_payment != doc.allow_card_payment:
         # Card toggle changed - need to regenerate invoice
-        frappe.log_error(
-            f"Card toggle changed for {doc.name}, regenerating invoice",
-            "Stripe Integration"
-        )
+        frappe.logger("stripe_integration").info(f"Card toggle changed for {doc.name}, regenerating invoice")
         regenerate_stripe_invoice(doc.name)
 
 
-def _create_stripe_invoice_internal(doc):
+def _create_stripe_invoice_internal(doc, customer_country=None):
     """
     Internal function to create Stripe Invoice.
     
     Args:
         doc: Payment Request document
+        customer_country: Customer's country, if the caller already resolved it
     """
-    import stripe
-    
     settings = get_stripe_settings()
-    stripe.api_key = settings.get_password("api_key")
+    stripe.api_key = get_stripe_api_key()
     
     # Validate required fields
-    if not doc.grand_total or doc.grand_total <= 0:
-        frappe.throw(_("Payment Request must have a valid amount"))
-    
-    if not doc.email_to:
-        frappe.throw(_("Payment Request must have a customer email"))
+    validate_payment_request_for_stripe(doc)
     
     # Get customer info
     customer = get_erpnext_customer(doc)
-    customer_country = get_customer_country(customer) if customer else "US"
-    country_lower = (customer_country or "").strip().lower()
-    is_us_customer = country_lower in ("us", "united states", "united states of america", "usa")
+    if customer_country is None:
+        customer_country = get_customer_country(customer) if customer else "US"
+    is_us_customer = is_us_country(customer_country)
     
     # Get or create Stripe customer
-    stripe_customer_id = get_or_create_stripe_customer(doc, customer, stripe)
+    stripe_customer_id = get_or_create_stripe_customer(doc, customer)
     
     # Calculate amounts and payment methods
     base_amount = doc.grand_total
@@ -131,24 +211,20 @@ def _create_stripe_invoice_internal(doc):
     
     # International customers — skip Stripe, handle wire transfer manually
     if not is_us_customer:
-        doc.db_set("stripe_payment_status", "N/A", update_modified=False)
-        frappe.msgprint(
-            _("International customer — Stripe invoice not created. Handle wire transfer manually."),
-            alert=True,
-            indicator='orange'
-        )
+        skip_international_customer(doc)
         return
 
     # Determine payment methods (US customers only at this point)
-    payment_method_types = ['us_bank_account']  # ACH Direct Debit
-    if allow_card:
-        payment_method_types.append('card')
+    payment_method_types = ACH_CARD_METHODS if allow_card else ACH_ONLY_METHODS
 
     # Create Stripe Invoice
     try:
+        currency = doc.currency.lower() if doc.currency else 'usd'
+
         # Build invoice create params
         invoice_params = {
             'customer': stripe_customer_id,
+            'currency': currency,
             'collection_method': 'send_invoice',
             'due_date': get_due_date_timestamp(doc),
             'auto_advance': False,  # Don't auto-finalize
@@ -164,33 +240,37 @@ def _create_stripe_invoice_internal(doc):
         }
 
         # Create invoice
-        invoice = stripe.Invoice.create(**invoice_params)
+        try:
+            invoice = stripe.Invoice.create(**invoice_params)
+        except stripe.error.InvalidRequestError as e:
+            if e.code != 'resource_missing' or e.param != 'customer':
+                raise
+            # Stripe customer (e.g. from the email cache) was deleted - drop it and resolve once more
+            _forget_stripe_customer_id(get_customer_email(doc))
+            invoice_params['customer'] = get_or_create_stripe_customer(doc, customer)
+            invoice = stripe.Invoice.create(**invoice_params)
         
         # Add line item(s)
         description = get_invoice_description(doc)
-        currency = doc.currency.lower() if doc.currency else 'usd'
 
-        # Add base amount line item
-        stripe.InvoiceItem.create(
-            customer=stripe_customer_id,
-            invoice=invoice.id,
-            amount=int(base_amount * 100),  # Convert to cents
-            currency=currency,
-            description=f"Payment for {doc.reference_name}" if doc.reference_name else description,
-            metadata={'erpnext_invoice_number': doc.reference_name or ''}
-        )
+        # Base amount line item
+        lines = [{
+            'amount': int(base_amount * 100),  # Convert to cents
+            'description': f"Payment for {doc.reference_name}" if doc.reference_name else description,
+            'metadata': {'erpnext_invoice_number': doc.reference_name or ''}
+        }]
 
         # Add card processing fee as separate line item if card payments enabled
         if allow_card and doc.card_processing_fee:
             fee_percent = settings.card_fee_rate or 3
-            stripe.InvoiceItem.create(
-                customer=stripe_customer_id,
-                invoice=invoice.id,
-                amount=int(doc.card_processing_fee * 100),  # Convert to cents
-                currency=currency,
-                description=f"Card Processing Fee ({fee_percent}%)",
-                metadata={'fee_type': 'card_processing_fee'}
-            )
+            lines.append({
+                'amount': int(doc.card_processing_fee * 100),  # Convert to cents
+                'description': f"Card Processing Fee ({fee_percent}%)",
+                'metadata': {'fee_type': 'card_processing_fee'}
+            })
+
+        # Add all lines to the draft invoice in one request
+        stripe.Invoice.add_lines(invoice.id, lines=lines)
         
         # Finalize invoice to generate hosted URL
         finalized_invoice = stripe.Invoice.finalize_invoice(invoice.id)
@@ -200,15 +280,12 @@ def _create_stripe_invoice_internal(doc):
         doc.stripe_invoice_id = finalized_invoice.id
         doc.stripe_payment_status = "Pending"
         
-        # Update DB without triggering hooks/save recursion
+        # Update DB without triggering hooks/save recursion (notify open forms to refresh)
         doc.db_set({
             'stripe_invoice_url': doc.stripe_invoice_url,
             'stripe_invoice_id': doc.stripe_invoice_id,
             'stripe_payment_status': doc.stripe_payment_status 
-        })
-        
-        # Record rate limit timestamp
-        set_rate_limit_timestamp(doc.name)
+        }, notify=True)
         
         frappe.msgprint(
             _("Stripe Invoice created successfully. <a href='{0}' target='_blank'>View Invoice</a>").format(
@@ -226,59 +303,99 @@ def _create_stripe_invoice_internal(doc):
         frappe.throw(_("Failed to create Stripe invoice: {0}").format(str(e)))
 
 
-def get_or_create_stripe_customer(doc, customer, stripe):
+def get_or_create_stripe_customer(doc, customer):
     """
     Get existing Stripe customer or create new one.
-    Uses database locking to prevent race conditions.
+    Uses a Redis lock per email and a Customer row lock to prevent race conditions.
     
     Args:
         doc: Payment Request document
         customer: ERPNext Customer document or None
-        stripe: Stripe module
     
     Returns:
         str: Stripe Customer ID
     """
+    customer_email = get_customer_email(doc)
+    customer_name = customer.customer_name if customer else doc.party_name or customer_email
+
     if customer and customer.stripe_customer_id:
         try:
-            stripe.Customer.retrieve(customer.stripe_customer_id)
-            return customer.stripe_customer_id
+            existing = stripe.Customer.retrieve(customer.stripe_customer_id)
         except stripe.error.InvalidRequestError:
-            # Customer no longer exists in Stripe - clear stale ID
-            customer.stripe_customer_id = None
-            customer.save(ignore_permissions=True)
-            frappe.log_error(
-                f"Cleared stale Stripe customer ID for {customer.name}",
-                "Stripe Integration"
+            existing = None
+
+        # Deleted customers come back as {"deleted": true} rather than an error
+        if existing and not getattr(existing, "deleted", False):
+            return customer.stripe_customer_id
+
+        # Customer no longer exists in Stripe - clear stale ID
+        _forget_stripe_customer_id(customer_email)
+        customer.stripe_customer_id = None
+        frappe.db.set_value("Customer", customer.name, "stripe_customer_id", None, update_modified=False)
+        frappe.logger("stripe_integration").info(f"Cleared stale Stripe customer ID for {customer.name}")
+    
+    # Serialize lookup + create per email across workers so concurrent requests
+    # can't each create a Stripe customer for the same person
+    lock = frappe.cache().lock(
+        frappe.cache().make_key(f"stripe_customer_lock:{customer_email}"),
+        timeout=STRIPE_CUSTOMER_LOCK_TIMEOUT,
+        blocking_timeout=STRIPE_CUSTOMER_LOCK_WAIT
+    )
+    try:
+        acquired = lock.acquire()
+    except LockError as e:
+        frappe.throw(_("Could not lock Stripe customer lookup for {0}: {1}").format(customer_email, str(e)))
+    if not acquired:
+        frappe.throw(
+            _("Another request is creating the Stripe customer for {0}. Please try again shortly.").format(
+                customer_email
             )
-    
-    customer_email = (doc.email_to or "").split(",")[0].strip()
-    customer_name = customer.customer_name if customer else doc.party_name or customer_email
-    
-    # Try to find existing Stripe customer by email
+        )
+
     try:
-        existing_customers = stripe.Customer.list(email=customer_email, limit=1)
-        if existing_customers.data:
-            stripe_customer_id = existing_customers.data[0].id
-            
-            # Save to ERPNext Customer if exists
-            if customer:
-                customer.reload()
-                if not customer.stripe_customer_id:
-                    customer.stripe_customer_id = stripe_customer_id
-                    customer.save(ignore_permissions=True)
-            
-            return stripe_customer_id
-    except Exception as e:
-        frappe.log_error(f"Error searching Stripe customers: {str(e)}", "Stripe Integration")
+        return _find_or_create_stripe_customer(doc, customer, customer_email, customer_name)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # Lock expired mid-call; the customer lookup/create itself still succeeded
+            frappe.logger("stripe_integration").info(
+                f"Stripe customer lock for {customer_email} expired before release"
+            )
+
+
+def _find_or_create_stripe_customer(doc, customer, customer_email, customer_name):
+    """Look up the Stripe customer by email, creating it if none exists. Caller holds the email lock."""
+    # Try to find existing Stripe customer by email (recent lookups are cached in Redis)
+    stripe_customer_id = _get_cached_stripe_customer_id(customer_email)
+    if not stripe_customer_id:
+        try:
+            existing_customers = stripe.Customer.list(email=customer_email, limit=1)
+            if existing_customers.data:
+                stripe_customer_id = existing_customers.data[0].id
+                _cache_stripe_customer_id(customer_email, stripe_customer_id)
+        except Exception as e:
+            frappe.log_error(f"Error searching Stripe customers: {str(e)}", "Stripe Integration")
+
+    if stripe_customer_id:
+        # Save to ERPNext Customer if exists (and not set by a concurrent request)
+        if customer:
+            if not lock_customer_stripe_id(customer.name):
+                frappe.db.set_value(
+                    "Customer", customer.name, "stripe_customer_id", stripe_customer_id, update_modified=False
+                )
+            customer.stripe_customer_id = stripe_customer_id
+
+        return stripe_customer_id
     
     # Create new Stripe customer
     try:
         # Re-check if customer was created by concurrent request
         if customer:
-            customer.reload()
-            if customer.stripe_customer_id:
-                return customer.stripe_customer_id
+            existing_id = lock_customer_stripe_id(customer.name)
+            if existing_id:
+                customer.stripe_customer_id = existing_id
+                return existing_id
 
         # Create new Stripe customer
         stripe_customer = stripe.Customer.create(
@@ -290,10 +407,14 @@ def get_or_create_stripe_customer(doc, customer, stripe):
             }
         )
 
+        _cache_stripe_customer_id(customer_email, stripe_customer.id)
+
         # Save Stripe Customer ID to ERPNext
         if customer:
             customer.stripe_customer_id = stripe_customer.id
-            customer.save(ignore_permissions=True)
+            frappe.db.set_value(
+                "Customer", customer.name, "stripe_customer_id", stripe_customer.id, update_modified=False
+            )
 
         return stripe_customer.id
                 
@@ -303,15 +424,104 @@ def get_or_create_stripe_customer(doc, customer, stripe):
 
 
 def get_stripe_settings():
-    """Get Stripe Settings singleton."""
+    """
+    Get Stripe Settings singleton.
+
+    Served from a per-site, process-local cache for SETTINGS_CACHE_TTL seconds.
+    Saving Stripe Settings clears this worker's entry immediately; other
+    workers pick up the change when their entry expires.
+    """
+    entry = _get_settings_cache_entry()
+    return entry["settings"] if entry else None
+
+
+def get_stripe_api_key():
+    """Get the decrypted Stripe Secret Key from the settings cache."""
+    entry = _get_settings_cache_entry()
+    return entry["api_key"] if entry else None
+
+
+def get_stripe_webhook_secret():
+    """Get the decrypted Stripe webhook signing secret from the settings cache."""
+    entry = _get_settings_cache_entry()
+    return entry["webhook_secret"] if entry else None
+
+
+def clear_stripe_settings_cache():
+    """Drop this worker's cached Stripe Settings for the current site."""
+    _settings_cache.pop(frappe.local.site, None)
+
+
+def _get_settings_cache_entry():
+    """Return the cached settings entry for the current site, loading it on miss."""
+    site = frappe.local.site
+    entry = _settings_cache.get(site)
+    if entry and entry["expires_at"] > time.monotonic():
+        return entry
+
     try:
         settings = frappe.get_single("Stripe Settings")
-        if not settings.api_key:
-            return None
-        return settings
     except Exception:
         return None
 
+    if not settings.api_key:
+        return None
+
+    # Decrypt outside the try: a broken password must raise, not read as "not configured"
+    # (callers such as the void hooks would otherwise silently leave invoices payable)
+    entry = {
+        "expires_at": time.monotonic() + SETTINGS_CACHE_TTL,
+        "settings": settings,
+        "api_key": settings.get_password("api_key"),
+        "webhook_secret": settings.get_password("webhook_secret", raise_exception=False)
+    }
+
+    _settings_cache[site] = entry
+    return entry
+
+
+def get_customer_email(doc):
+    """Return the first address in a Payment Request's email_to."""
+    return (doc.email_to or "").split(",")[0].strip()
+
+
+def _stripe_customer_cache_key(email):
+    """Redis key for an email's Stripe Customer ID, scoped to the Stripe account (API key)."""
+    account = hashlib.sha256((get_stripe_api_key() or "").encode()).hexdigest()[:16]
+    return f"stripe_customer_by_email:{account}:{email}"
+
+
+def _get_cached_stripe_customer_id(email):
+    """Return the cached Stripe Customer ID for an email, if any."""
+    if not email:
+        return None
+    return frappe.cache().get_value(_stripe_customer_cache_key(email))
+
+
+def _cache_stripe_customer_id(email, stripe_customer_id):
+    """Remember the Stripe Customer ID for an email for STRIPE_CUSTOMER_CACHE_TTL seconds."""
+    if not email:
+        return
+    frappe.cache().set_value(
+        _stripe_customer_cache_key(email), stripe_customer_id, expires_in_sec=STRIPE_CUSTOMER_CACHE_TTL
+    )
+
+
+def _forget_stripe_customer_id(email):
+    """Drop an email's cached Stripe Customer ID (e.g. the customer was deleted in Stripe)."""
+    if not email:
+        return
+    frappe.cache().delete_value(_stripe_customer_cache_key(email))
+
+
+def lock_customer_stripe_id(customer_name):
+    """Lock the Customer row for this transaction and return its current stripe_customer_id."""
+    result = frappe.db.sql(
+        "SELECT stripe_customer_id FROM `tabCustomer` WHERE name = %s FOR UPDATE",
+        customer_name
+    )
+    return result[0][0] if result else None
+
 
 def get_erpnext_customer(doc):
     """Get ERPNext Customer from Payment Request."""
@@ -320,23 +530,44 @@ def get_erpnext_customer(doc):
     return None
 
 
+def is_us_country(country):
+    """Check whether a country value counts as US (Stripe invoicing is US-only)."""
+    return (country or "").strip().lower() in US_COUNTRY_NAMES
+
+
+def skip_international_customer(doc):
+    """Mark a Payment Request as not invoiced through Stripe (wire transfer handled manually)."""
+    doc.db_set("stripe_payment_status", "N/A", update_modified=False)
+    frappe.msgprint(
+        _("International customer — Stripe invoice not created. Handle wire transfer manually."),
+        alert=True,
+        indicator='orange'
+    )
+
+
 def get_customer_country(customer):
     """Get customer's country from primary address."""
     if not customer:
         return "US"
-    
-    # Try to get primary billing address
-    address = frappe.db.get_value(
-        "Dynamic Link",
-        {"link_doctype": "Customer", "link_name": customer.name, "parenttype": "Address"},
-        "parent"
+
+    # Try to get primary billing address - linked address and its validated country in one query
+    address = frappe.db.sql(
+        """
+        SELECT c.name
+        FROM `tabDynamic Link` dl
+        JOIN `tabAddress` a ON a.name = dl.parent
+        LEFT JOIN `tabCountry` c ON c.name = a.country
+        WHERE dl.link_doctype = 'Customer'
+            AND dl.link_name = %s
+            AND dl.parenttype = 'Address'
+        ORDER BY dl.modified DESC
+        LIMIT 1
+        """,
+        customer.name
     )
-    
+
     if address:
-        country = frappe.db.get_value("Address", address, "country")
-        if country and frappe.db.exists("Country", country):
-            return country
-        return "US"
+        return address[0][0] or "US"
 
     # Fall back to territory — check if it's a valid country name
     if customer.territory and frappe.db.exists("Country", customer.territory):
@@ -360,14 +591,16 @@ def get_due_date_timestamp(doc):
     if hasattr(doc, 'payment_due_date') and doc.payment_due_date:
         due_date = doc.payment_due_date
 
-    # 2. Try Reference Document due date
+    # 2. Try Reference Document due date (first set field, in priority order, from one query)
     elif doc.reference_doctype and doc.reference_name:
         try:
-            for field in ['due_date', 'payment_due_date', 'bill_date']:
-                val = frappe.db.get_value(doc.reference_doctype, doc.reference_name, field)
-                if val:
-                    due_date = val
-                    break
+            meta = frappe.get_meta(doc.reference_doctype)
+            fields = [f for f in DUE_DATE_FIELDS if meta.has_field(f)]
+            if fields:
+                values = frappe.db.get_value(
+                    doc.reference_doctype, doc.reference_name, fields, as_dict=True
+                ) or {}
+                due_date = next((values[f] for f in fields if values.get(f)), None)
         except Exception:
             pass
 
@@ -414,24 +647,53 @@ def get_invoice_description(doc):
     return " | ".join(parts)
 
 
-def is_rate_limited(payment_request_name):
-    """Check if invoice creation is rate limited."""
-    cache_key = f"stripe_invoice_created_{payment_request_name}"
-    last_created = frappe.cache().get_value(cache_key)
-    
-    if last_created:
-        last_time = get_datetime(last_created)
-        diff = time_diff_in_seconds(now_datetime(), last_time)
-        if diff < RATE_LIMIT_SECONDS:
+def is_rate_limited(name):
+    """
+    Check the invoice-creation rate limit and claim the window if it's free.
+
+    Allows one attempt per `name` every RATE_LIMIT_SECONDS. A single atomic
+    SET NX PX both checks and claims, so concurrent callers can't both get
+    through.
+
+    Returns:
+        bool: True if the window was already claimed
+    """
+    # Known-limited in this worker: skip the Redis round-trip until the window frees up
+    local_key = (frappe.local.site, name)
+    expires_at = _rate_limit_local.get(local_key)
+    if expires_at:
+        if expires_at > time.monotonic():
             return True
-    
-    return False
+        _rate_limit_local.pop(local_key, None)
+
+    cache_key = frappe.cache().make_key(f"stripe_rate_limit_claim_{name}")
+    if frappe.cache().set(cache_key, 1, nx=True, px=RATE_LIMIT_SECONDS * 1000):
+        return False
 
+    # Limited: one extra PTTL so this worker can skip Redis until the claim expires
+    retry_after_ms = frappe.cache().pttl(cache_key)
+    if retry_after_ms and retry_after_ms > 0:
+        _remember_rate_limited(name, retry_after_ms / 1000)
+    return True
 
-def set_rate_limit_timestamp(payment_request_name):
-    """Set rate limit timestamp for payment request."""
-    cache_key = f"stripe_invoice_created_{payment_request_name}"
-    frappe.cache().set_value(cache_key, now_datetime(), expires_in_sec=RATE_LIMIT_SECONDS * 2) 
+
+def release_rate_limit(name):
+    """Give back a window claimed by is_rate_limited (e.g. when the submit rolls back)."""
+    _rate_limit_local.pop((frappe.local.site, name), None)
+    frappe.cache().delete(frappe.cache().make_key(f"stripe_rate_limit_claim_{name}"))
+
+
+def _remember_rate_limited(name, seconds):
+    """Mark a rate-limit key as limited in this worker for `seconds`."""
+    now = time.monotonic()
+    if len(_rate_limit_local) >= RATE_LIMIT_LOCAL_MAXSIZE:
+        # Drop expired entries; if everything is still live, start over rather than grow unbounded
+        for key in [k for k, exp in _rate_limit_local.items() if exp <= now]:
+            del _rate_limit_local[key]
+        if len(_rate_limit_local) >= RATE_LIMIT_LOCAL_MAXSIZE:
+            _rate_limit_local.clear()
+
+    _rate_limit_local[(frappe.local.site, name)] = now + seconds
 
 
 @frappe.whitelist()
@@ -445,8 +707,6 @@ def regenerate_stripe_invoice(payment_request_name):
     Returns:
         dict: Result with new invoice URL
     """
-    import stripe
-    
     doc = frappe.get_doc("Payment Request", payment_request_name)
     
     # Check if invoice exists and is pending
@@ -456,8 +716,7 @@ def regenerate_stripe_invoice(payment_request_name):
     if doc.stripe_payment_status == "Paid":
         frappe.throw(_("Cannot regenerate invoice - payment already received"))
     
-    settings = get_stripe_settings()
-    stripe.api_key = settings.get_password("api_key")
+    stripe.api_key = get_stripe_api_key()
     
     try:
         # Cancel existing invoice (delete if draft, void if open)
@@ -467,11 +726,12 @@ def regenerate_stripe_invoice(payment_request_name):
         elif existing.status == "open":
             stripe.Invoice.void_invoice(doc.stripe_invoice_id)
 
-        # Clear existing invoice data
-        doc.stripe_invoice_id = None
-        doc.stripe_invoice_url = None
-        doc.stripe_payment_status = None
-        doc.save(ignore_permissions=True)
+        # Clear existing invoice data (db_set avoids re-running save hooks, including on_update)
+        doc.db_set({
+            'stripe_invoice_id': None,
+            'stripe_invoice_url': None,
+            'stripe_payment_status': None
+        }, update_modified=False)
         
         # Create new invoice
         _create_stripe_invoice_internal(doc)
@@ -501,15 +761,12 @@ def get_stripe_invoice_status(payment_request_name):
     Returns:
         dict: Invoice status info
     """
-    import stripe
-    
     doc = frappe.get_doc("Payment Request", payment_request_name)
     
     if not doc.stripe_invoice_id:
         return {"status": "no_invoice"}
     
-    settings = get_stripe_settings()
-    stripe.api_key = settings.get_password("api_key")
+    stripe.api_key = get_stripe_api_key()
     
     try:
         invoice = stripe.Invoice.retrieve(doc.stripe_invoice_id)
@@ -532,14 +789,15 @@ def void_stripe_invoice_on_manual_payment(doc, method=None):
     Void open Stripe Invoices when a Payment Entry is manually submitted.
     Triggered by on_submit hook on Payment Entry.
 
-    Checks if any linked Payment Request has an open Stripe invoice and voids it
-    to prevent double payment.
+    Checks if any linked Payment Request has an open Stripe invoice and queues
+    a background job to void it, preventing double payment without blocking
+    the submit on Stripe round-trips.
     """
-    import stripe
+    payment_request_names = []
 
     # Check each reference in the Payment Entry for linked Payment Requests
     for ref in doc.references:
-        payment_requests = frappe.get_all(
+        payment_request_names += frappe.get_all(
             "Payment Request",
             filters={
                 "reference_doctype": ref.reference_doctype,
@@ -548,46 +806,95 @@ def void_stripe_invoice_on_manual_payment(doc, method=None):
                 "stripe_payment_status": "Pending",
                 "docstatus": 1
             },
-            fields=["name", "stripe_invoice_id"]
+            pluck="name"
         )
 
-        if not payment_requests:
-            continue
-
-        settings = get_stripe_settings()
-        if not settings:
-            continue
-
-        stripe.api_key = settings.get_password("api_key")
-
-        for pr in payment_requests:
-            try:
-                invoice = stripe.Invoice.retrieve(pr.stripe_invoice_id)
-
-                if invoice.status in ("open", "draft"):
-                    if invoice.status == "draft":
-                        stripe.Invoice.delete(pr.stripe_invoice_id)
-                    else:
-                        stripe.Invoice.void_invoice(pr.stripe_invoice_id)
-
-                    frappe.db.set_value("Payment Request", pr.name, {
-                        "status": "Paid",
-                        "stripe_payment_status": "Voided"
-                    }, update_modified=False)
-
-                    frappe.msgprint(
-                        f"Stripe Invoice {pr.stripe_invoice_id} voided for {pr.name} — payment received manually.",
-                        indicator="green", alert=True
-                    )
-            except stripe.error.StripeError as e:
-                frappe.log_error(
-                    f"Failed to void Stripe Invoice {pr.stripe_invoice_id} after manual payment: {str(e)}",
-                    "Stripe Invoice Void Error"
-                )
-                frappe.msgprint(
-                    f"Could not void Stripe Invoice {pr.stripe_invoice_id}: {str(e)}. Please void it manually in Stripe.",
-                    indicator="red", alert=True
-                )
+    if not payment_request_names or not get_stripe_settings():
+        return
+
+    frappe.enqueue(
+        "payments.utils.void_stripe_invoices_for_manual_payment",
+        queue="short",
+        payment_request_names=payment_request_names,
+        payment_entry=doc.name,
+        enqueue_after_commit=True
+    )
+    frappe.msgprint(
+        _("Voiding of open Stripe Invoices for {0} has been queued — payment received manually.").format(
+            ", ".join(payment_request_names)
+        ),
+        indicator="blue", alert=True
+    )
+
+
+def void_stripe_invoices_for_manual_payment(payment_request_names, payment_entry=None):
+    """
+    Background job: void the Stripe Invoices of Payment Requests paid manually.
+
+    Args:
+        payment_request_names: Names of Payment Requests to void
+        payment_entry: Name of the Payment Entry that settled them (for logging)
+    """
+    # Re-check status — a webhook may have marked some as paid since enqueue
+    payment_requests = frappe.get_all(
+        "Payment Request",
+        filters={
+            "name": ["in", payment_request_names],
+            "stripe_invoice_id": ["is", "set"],
+            "stripe_payment_status": "Pending"
+        },
+        fields=["name", "stripe_invoice_id"]
+    )
+
+    if not payment_requests:
+        return
+
+    settings = get_stripe_settings()
+    if not settings:
+        return
+
+    stripe.api_key = get_stripe_api_key()
+
+    for pr in payment_requests:
+        try:
+            invoice = stripe.Invoice.retrieve(pr.stripe_invoice_id)
+
+            if invoice.status in ("open", "draft"):
+                if invoice.status == "draft":
+                    stripe.Invoice.delete(pr.stripe_invoice_id)
+                else:
+                    stripe.Invoice.void_invoice(pr.stripe_invoice_id)
+
+                frappe.db.set_value("Payment Request", pr.name, {
+                    "status": "Paid",
+                    "stripe_payment_status": "Voided"
+                }, update_modified=False)
+        except stripe.error.StripeError as e:
+            frappe.log_error(
+                f"Failed to void Stripe Invoice {pr.stripe_invoice_id} for {pr.name} after manual "
+                f"payment {payment_entry}: {str(e)}. Please void it manually in Stripe.",
+                "Stripe Invoice Void Error"
+            )
+            notify_job_user(
+                _("Could not void Stripe Invoice {0} for {1}: {2}. Please void it manually in Stripe.").format(
+                    pr.stripe_invoice_id, pr.name, str(e)
+                ),
+                title=_("Stripe Invoice Void Error")
+            )
+
+
+def notify_job_user(message, title=None, indicator="red"):
+    """
+    Show a message to the user who enqueued the current background job.
+
+    Jobs run as the enqueuing user, so msgprint from a job never reaches
+    them — push it over realtime instead.
+    """
+    frappe.publish_realtime(
+        "msgprint",
+        {"message": message, "title": title, "indicator": indicator},
+        user=frappe.session.user
+    )
 
 
 def void_stripe_invoice_on_cancel(doc, method=None):
@@ -605,13 +912,11 @@ def void_stripe_invoice_on_cancel(doc, method=None):
     if doc.stripe_payment_status and doc.stripe_payment_status not in ("Pending", ""):
         return
 
-    import stripe
-
     settings = get_stripe_settings()
     if not settings:
         return
 
-    stripe.api_key = settings.get_password("api_key")
+    stripe.api_key = get_stripe_api_key()
 
     try:
         invoice = stripe.Invoice.retrieve(doc.stripe_invoice_id)
@@ -2,10 +2,18 @@
 # For license information, please see license.txt
 
 import frappe
+import stripe
 from frappe import _
 from frappe.utils import now_datetime
+from payments.utils import get_stripe_settings, get_stripe_api_key, get_stripe_webhook_secret
 import json
 
+try:
+    # Faster C decoder when installed; same results and errors (JSONDecodeError) as json.loads
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 @frappe.whitelist(allow_guest=True)
 def handle_stripe_webhook():
@@ -13,12 +21,12 @@ def handle_stripe_webhook():
     Handle incoming Stripe webhook events.
     
     This endpoint receives webhook events from Stripe and processes them accordingly.
-    It verifies the webhook signature, checks for idempotency, and processes the event.
+    It verifies the webhook signature, checks for idempotency, records the event and
+    queues it for process_webhook_event. The queue defaults to "short" and can be
+    changed with the `stripe_webhook_queue` site config key.
     
     Endpoint: /api/method/payments.webhook.handle_stripe_webhook
     """
-    import stripe
-    
     # Get raw request body
     payload = frappe.request.get_data(as_text=True)
     sig_header = frappe.request.headers.get('Stripe-Signature')
@@ -26,81 +34,143 @@ def handle_stripe_webhook():
     if not payload:
         frappe.throw(_("No payload received"), frappe.ValidationError)
     
-    # Get Stripe settings
+    # Get Stripe settings (served from the per-worker settings cache)
     try:
-        settings = frappe.get_single("Stripe Settings")
-        webhook_secret = settings.get_password("webhook_secret")
-        stripe.api_key = settings.get_password("api_key")
+        webhook_secret = get_stripe_webhook_secret()
+        api_key = get_stripe_api_key()
     except Exception as e:
         frappe.log_error(f"Failed to get Stripe settings: {str(e)}", "Stripe Webhook Error")
         return {"status": "error", "message": "Configuration error"}
+
+    if not webhook_secret:
+        frappe.log_error(
+            "Failed to get Stripe settings: API key and webhook secret must be set in Stripe Settings",
+            "Stripe Webhook Error"
+        )
+        return {"status": "error", "message": "Configuration error"}
+    stripe.api_key = api_key
     
-    # Verify webhook signature
-    event = None
-    if webhook_secret and sig_header:
-        try:
-            event = stripe.Webhook.construct_event(
-                payload, sig_header, webhook_secret
-            )
-        except stripe.error.SignatureVerificationError as e:
-            frappe.log_error(f"Webhook signature verification failed: {str(e)}", "Stripe Webhook Error")
-            frappe.throw(_("Invalid webhook signature"), frappe.AuthenticationError)
-    else:
-        # If no webhook secret configured, parse payload directly (not recommended for production)
-        try:
-            event = json.loads(payload)
-        except json.JSONDecodeError:
-            frappe.throw(_("Invalid JSON payload"), frappe.ValidationError)
+    # Verify webhook signature (header only - the payload is parsed once below,
+    # without building a StripeObject tree we'd only read as a dict)
+    if not sig_header:
+        frappe.throw(_("Missing Stripe-Signature header"), frappe.AuthenticationError)
+    try:
+        stripe.WebhookSignature.verify_header(
+            payload, sig_header, webhook_secret, stripe.Webhook.DEFAULT_TOLERANCE
+        )
+    except stripe.error.SignatureVerificationError as e:
+        frappe.log_error(f"Webhook signature verification failed: {str(e)}", "Stripe Webhook Error")
+        frappe.throw(_("Invalid webhook signature"), frappe.AuthenticationError)
+
+    try:
+        event = json_loads(payload)
+    except json.JSONDecodeError:
+        frappe.throw(_("Invalid JSON payload"), frappe.ValidationError)
     
+    event_id = event.get('id')
+    event_type = event.get('type')
+
+    # Reject malformed events before any logging or DB work
+    if not event_id or not event_type:
+        frappe.throw(_("Webhook event is missing id or type"), frappe.ValidationError)
+
     # Run as Administrator after signature is verified
     frappe.set_user("Administrator")
 
-    event_id = event.get('id')
+    frappe.logger("stripe_webhook").info(f"Received Stripe webhook: {event_type} ({event_id})")
+    
+    # Record event before processing. The insert is the idempotency check: event_id is
+    # the primary key, so a redelivered event fails here without a separate lookup.
+    try:
+        record_webhook_event(event, payload, status="Queued")
+    except frappe.DuplicateEntryError:
+        status = frappe.db.get_value("Stripe Webhook Event", event_id, "status")
+        if status == "Success":
+            frappe.logger("stripe_webhook").info(f"Event already processed: {event_id}")
+            return {"status": "already_processed", "event_id": event_id}
+
+        # First delivery never finished (job lost, worker killed) or failed - process it again
+        if status == "Failed":
+            frappe.db.set_value(
+                "Stripe Webhook Event", event_id, {"status": "Queued", "error_message": None},
+                update_modified=False
+            )
+        frappe.logger("stripe_webhook").info(f"Re-queuing {status} event: {event_id}")
+
+    # Process in the background so Stripe gets its 200 right away
+    enqueue_webhook_event(event_id, payload)
+
+    return {"status": "queued", "event_id": event_id}
+
+
+def enqueue_webhook_event(event_id, payload):
+    """
+    Queue process_webhook_event for a recorded event.
+
+    The job id is the event id, so a redelivery while the first job is still
+    queued or running doesn't schedule it twice.
+    """
+    frappe.enqueue(
+        "payments.webhook.process_webhook_event",
+        queue=frappe.conf.get("stripe_webhook_queue") or "short",
+        job_id=event_id,
+        deduplicate=True,
+        event_id=event_id,
+        payload=payload,
+        enqueue_after_commit=True
+    )
+
+
+def process_webhook_event(event_id, payload):
+    """
+    Background job: process a recorded Stripe webhook event.
+    Enqueued by handle_stripe_webhook after the signature has been verified.
+
+    Args:
+        event_id: Stripe Event ID (name of the Stripe Webhook Event)
+        payload: Raw webhook request body
+    """
+    # The job commits once on return, covering the event status and whatever the handler wrote.
+    # Row lock: a concurrent job for the same event waits here until this one commits, then
+    # sees the final status and exits.
+    webhook_event_doc = frappe.get_doc("Stripe Webhook Event", event_id, for_update=True)
+
+    # Already handled (e.g. a re-queued duplicate after the first job finished)
+    if webhook_event_doc.status != "Queued":
+        return
+
+    event = json_loads(payload)
     event_type = event.get('type')
 
-    frappe.log_error(f"Received Stripe webhook: {event_type} ({event_id})", "Stripe Webhook")
-    
-    # Idempotency check - skip if already processed
-    if is_event_processed(event_id):
-        frappe.log_error(f"Event already processed: {event_id}", "Stripe Webhook")
-        return {"status": "already_processed", "event_id": event_id}
-    
-    # Record event before processing (for idempotency)
-    webhook_event_doc = record_webhook_event(event)
-    
     try:
         # Process event based on type
         result = process_event(event, event_type)
         
         # Update webhook event status
         webhook_event_doc.status = "Success"
+        webhook_event_doc.processed_at = now_datetime()
         webhook_event_doc.save(ignore_permissions=True)
-        frappe.db.commit()
-        
-        return {"status": "success", "event_id": event_id, "result": result}
+
+        frappe.logger("stripe_webhook").info(f"Processed Stripe webhook {event_type} ({event_id}): {result}")
         
     except Exception as e:
         # Record error
         webhook_event_doc.status = "Failed"
+        webhook_event_doc.processed_at = now_datetime()
         webhook_event_doc.error_message = str(e)
         webhook_event_doc.save(ignore_permissions=True)
-        frappe.db.commit()
         
         frappe.log_error(str(e), f"Webhook Error: {event_id}")
-        return {"status": "error", "event_id": event_id, "error": str(e)}
-
-
-def is_event_processed(event_id):
-    """Check if a Stripe event has already been processed."""
-    return frappe.db.exists("Stripe Webhook Event", {"event_id": event_id})
 
 
-def record_webhook_event(event):
+def record_webhook_event(event, payload, status="Success"):
     """
     Record webhook event for idempotency tracking.
     
     Args:
-        event: Stripe event object
+        event: Parsed Stripe event
+        payload: Raw webhook request body, stored as received
+        status: Initial status ("Queued" until the background job processes it)
     
     Returns:
         Stripe Webhook Event document
@@ -132,15 +202,14 @@ def record_webhook_event(event):
         "event_id": event_id,
         "event_type": event_type,
         "processed_at": now_datetime(),
-        "status": "Success",  # Will be updated if processing fails
+        "status": status,
         "payment_request": payment_request,
         "stripe_invoice_id": invoice_id,
         "amount": (amount / 100) if amount else 0,  # Convert from cents
         "currency": currency.upper() if currency else "",
-        "raw_payload": json.dumps(event, indent=2)[:10000]  # Limit size
+        "raw_payload": payload[:10000]  # Limit size
     })
     doc.insert(ignore_permissions=True)
-    frappe.db.commit()
     
     return doc
 
@@ -156,15 +225,7 @@ def process_event(event, event_type):
     Returns:
         dict: Processing result
     """
-    handlers = {
-        'invoice.paid': handle_invoice_paid,
-        'invoice.payment_failed': handle_invoice_payment_failed,
-        'invoice.voided': handle_invoice_voided,
-        'invoice.payment_action_required': handle_invoice_action_required,
-        'payment_intent.succeeded': handle_payment_intent_succeeded,
-    }
-    
-    handler = handlers.get(event_type)
+    handler = EVENT_HANDLERS.get(event_type)
     if handler:
         return handler(event)
     else:
@@ -182,8 +243,6 @@ def handle_invoice_paid(event):
     Returns:
         dict: Processing result
     """
-    import stripe
-
     invoice = event.get('data', {}).get('object', {})
     invoice_id = invoice.get('id')
 
@@ -209,7 +268,6 @@ def handle_invoice_paid(event):
             "Review and refund if needed.",
             "Stripe Payment on Cancelled Request"
         )
-        frappe.db.commit()
         return {"message": f"Payment Request {payment_request_name} is cancelled but Stripe collected payment — logged for review"}
 
     # Update Payment Request status (use set_value for submitted docs)
@@ -232,8 +290,7 @@ def handle_invoice_paid(event):
 
         if charge_id:
             try:
-                settings = frappe.get_single("Stripe Settings")
-                stripe.api_key = settings.get_password("api_key")
+                stripe.api_key = get_stripe_api_key()
 
                 charge = stripe.Charge.retrieve(charge_id)
                 if charge.balance_transaction:
@@ -261,7 +318,6 @@ def handle_invoice_paid(event):
             except Exception as e:
                 frappe.log_error(f"Failed to record card fee income: {str(e)}", "Stripe Webhook Error")
 
-        frappe.db.commit()
         return result
 
     except Exception as e:
@@ -291,7 +347,7 @@ def handle_invoice_payment_failed(event):
     }, update_modified=False)
     
     # Log failure reason
-    failure_message = invoice.get('last_finalization_error', {}).get('message', 'Unknown error')
+    failure_message = (invoice.get('last_finalization_error') or {}).get('message') or 'Unknown error'
     frappe.log_error(
         f"Payment failed for {payment_request_name}: {failure_message}",
         "Stripe Payment Failed"
@@ -382,7 +438,6 @@ def handle_payment_intent_succeeded(event):
             "Review and refund if needed.",
             "Stripe Payment on Cancelled Request"
         )
-        frappe.db.commit()
         return {"message": f"Payment Request {payment_request_name} is cancelled but Stripe collected payment — logged for review"}
 
     # Update status (use set_value for submitted docs)
@@ -393,9 +448,7 @@ def handle_payment_intent_succeeded(event):
     }, update_modified=False)
     
     # Fetch invoice for payment entry creation
-    import stripe
-    settings = frappe.get_single("Stripe Settings")
-    stripe.api_key = settings.get_password("api_key")
+    stripe.api_key = get_stripe_api_key()
     
     try:
         invoice = stripe.Invoice.retrieve(invoice_id)
@@ -413,7 +466,6 @@ def handle_payment_intent_succeeded(event):
                 frappe.log_error(f"Failed to fetch Stripe fee: {str(e)}", "Stripe Webhook")
 
         payment_entry = create_payment_entry(payment_request, invoice, stripe_fee=stripe_fee)
-        frappe.db.commit()
 
         return {
             "message": "Payment recorded via payment_intent.succeeded",
@@ -428,6 +480,16 @@ def handle_payment_intent_succeeded(event):
         return {"message": f"Status updated but Payment Entry creation failed: {str(e)}"}
 
 
+# Event type -> handler, built once at import (handlers are defined above)
+EVENT_HANDLERS = {
+    'invoice.paid': handle_invoice_paid,
+    'invoice.payment_failed': handle_invoice_payment_failed,
+    'invoice.voided': handle_invoice_voided,
+    'invoice.payment_action_required': handle_invoice_action_required,
+    'payment_intent.succeeded': handle_payment_intent_succeeded,
+}
+
+
 def find_payment_request(invoice):
     """
     Find Payment Request for a Stripe invoice.
@@ -475,10 +537,7 @@ def create_payment_entry(payment_request, invoice, stripe_fee=0):
         }
     )
     if existing:
-        frappe.log_error(
-            f"Payment Entry already exists: {existing}",
-            "Stripe Webhook"
-        )
+        frappe.logger("stripe_webhook").info(f"Payment Entry already exists: {existing}")
         return frappe.get_doc("Payment Entry", existing)
     
     # Get amount in proper currency
@@ -496,8 +555,8 @@ def create_payment_entry(payment_request, invoice, stripe_fee=0):
         frappe.throw(_("Company not found for Payment Entry"))
     
     # Get payment accounts - prefer clearing account from Stripe Settings
-    settings = frappe.get_single("Stripe Settings")
-    payment_account = settings.clearing_account if settings.clearing_account else None
+    settings = get_stripe_settings()
+    payment_account = settings.clearing_account if settings and settings.clearing_account else None
 
     mode_of_payment = "Stripe"
 
@@ -515,7 +574,7 @@ def create_payment_entry(payment_request, invoice, stripe_fee=0):
 
     if not payment_account:
         # Try to get default bank account
-        payment_account = frappe.db.get_value(
+        payment_account = frappe.get_cached_value(
             "Company",
             company,
             "default_bank_account"
@@ -560,9 +619,8 @@ def create_payment_entry(payment_request, invoice, stripe_fee=0):
         pe.insert(ignore_permissions=True)
         pe.submit()
         
-        frappe.log_error(
-            f"Created Payment Entry {pe.name} for Payment Request {payment_request.name}",
-            "Stripe Webhook"
+        frappe.logger("stripe_webhook").info(
+            f"Created Payment Entry {pe.name} for Payment Request {payment_request.name}"
         )
         
         return pe
@@ -577,7 +635,7 @@ def create_payment_entry(payment_request, invoice, stripe_fee=0):
 
 def get_receivable_account(company):
     """Get default receivable account for company."""
-    account = frappe.db.get_value(
+    account = frappe.get_cached_value(
         "Company",
         company,
         "default_receivable_account"
@@ -609,10 +667,10 @@ def record_stripe_fee(payment_request, fee_amount, stripe_invoice_id):
     Returns:
         str: Journal Entry name or None
     """
-    settings = frappe.get_single("Stripe Settings")
+    settings = get_stripe_settings()
 
     # Check if accounts are configured
-    if not settings.fee_expense_account or not settings.clearing_account:
+    if not settings or not settings.fee_expense_account or not settings.clearing_account:
         frappe.log_error(
             "Stripe fee accounts not configured in Stripe Settings",
             "Stripe Webhook"
@@ -652,9 +710,8 @@ def record_stripe_fee(payment_request, fee_amount, stripe_invoice_id):
     je.insert(ignore_permissions=True)
     je.submit()
 
-    frappe.log_error(
-        f"Created Stripe fee Journal Entry {je.name} for ${fee_amount}",
-        "Stripe Webhook"
+    frappe.logger("stripe_webhook").info(
+        f"Created Stripe fee Journal Entry {je.name} for ${fee_amount}"
     )
 
     return je.name
@@ -676,10 +733,10 @@ def record_card_fee_income(payment_request, fee_amount, stripe_invoice_id):
     Returns:
         str: Journal Entry name or None
     """
-    settings = frappe.get_single("Stripe Settings")
+    settings = get_stripe_settings()
 
     # Check if accounts are configured
-    if not settings.card_fee_income_account or not settings.clearing_account:
+    if not settings or not settings.card_fee_income_account or not settings.clearing_account:
         frappe.log_error(
             "Card fee income accounts not configured in Stripe Settings",
             "Stripe Webhook"
@@ -719,9 +776,8 @@ def record_card_fee_income(payment_request, fee_amount, stripe_invoice_id):
     je.insert(ignore_permissions=True)
     je.submit()
 
-    frappe.log_error(
-        f"Created card fee income Journal Entry {je.name} for ${fee_amount}",
-        "Stripe Webhook"
+    frappe.logger("stripe_webhook").info(
+        f"Created card fee income Journal Entry {je.name} for ${fee_amount}"
     )
 
     return je.name